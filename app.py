@@ -10,6 +10,11 @@ import logging
 from colorama import Fore, Style
 from plugins.Web.web_plugin import WebPlugin
 from plugins.Selenium.selenium_plugin import SeleniumPlugin
+from plugins.shared_ai import close_ai_clients
+
+def mask_secret(secret: str | None) -> str:
+    return "***" if secret else "<not set>"
+
 
 async def main():
     load_dotenv()
@@ -23,15 +28,15 @@ async def main():
     logging.debug("Reading environment variables")
     azure_ai_endpoint = os.getenv("AZURE_AI_ENDPOINT")
     azure_ai_key = os.getenv("AZURE_AI_KEY")
-    logging.debug(f"Azure AI endpoint: {azure_ai_endpoint}, Azure AI key: {azure_ai_key}")
+    logging.debug("Azure AI endpoint: %s, Azure AI key: %s", azure_ai_endpoint, mask_secret(azure_ai_key))
     chat_deployment_name = os.getenv("AZURE_CHAT_DEPLOYMENT_NAME")
     embedding_deployment_name = os.getenv("AZURE_EMBEDDING_DEPLOYMENT_NAME")
-    logging.debug(f"Chat deployment name: {chat_deployment_name}, Embedding deployment name: {embedding_deployment_name}")
+    logging.debug("Chat deployment name: %s, Embedding deployment name: %s", chat_deployment_name, embedding_deployment_name)
     azure_search_endpoint = os.getenv("AZURE_SEARCH_ENDPOINT")
     azure_search_key = os.getenv("AZURE_SEARCH_KEY")
-    logging.debug(f"Azure Search endpoint: {azure_search_endpoint}, Azure Search key: {azure_search_key}")
+    logging.debug("Azure Search endpoint: %s, Azure Search key: %s", azure_search_endpoint, mask_secret(azure_search_key))
     bing_search_key = os.getenv("BING_SEARCH_KEY")
-    logging.debug(f"Bing Search key: {bing_search_key}")
+    logging.debug("Bing Search key: %s", mask_secret(bing_search_key))
 
     # Set up the kernel
     logging.debug("Setting up the kernel")
@@ -72,22 +77,32 @@ async def main():
 
     # Chat loop
     logging.debug("Starting chat loop")
-    while True:
+    try:
+        while True:
 
-        # Get user input
-        user_input = input(f"\n{Fore.GREEN}You: ")
-        print(f"{Style.RESET_ALL}")
+            # Get user input
+            user_input = input(f"\n{Fore.GREEN}You: ")
+            print(f"{Style.RESET_ALL}")
         
-        # Get reply
-        chat_history.add_user_message(user_input)
-        reply = await chat_completion.get_chat_message_content(
-            chat_history=chat_history,
-            settings=execution_settings,
-            kernel=kernel
-        )
-        chat_history.add_assistant_message(str(reply))
-
-        print(f"{Fore.YELLOW}Assistant: {reply}{Style.RESET_ALL}")
+            # Stream the reply as it arrives
+            chat_history.add_user_message(user_input)
+            reply = ""
+            async for chunk in chat_completion.get_streaming_chat_message_content(
+                chat_history=chat_history,
+                settings=execution_settings,
+                kernel=kernel
+            ):
+                if chunk and str(chunk):
+                    # Print the prefix only once text arrives, so plugin logs during tool calls don't end up in the reply line
+                    if not reply:
+                        print(f"{Fore.YELLOW}Assistant: ", end="")
+                    print(str(chunk), end="", flush=True)
+                    reply += str(chunk)
+            print(Style.RESET_ALL)
+            chat_history.add_assistant_message(reply)
+    finally:
+        # Release the shared AI clients and their credentials
+        await close_ai_clients()
 
 
 if __name__ == "__main__":
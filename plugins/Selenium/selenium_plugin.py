@@ -1,17 +1,26 @@
 from selenium import webdriver
-from selenium.webdriver.common.by import By
 from selenium.webdriver.common.keys import Keys
 from selenium.webdriver.remote.webelement import WebElement
+from selenium.webdriver.support.ui import WebDriverWait
+from selenium.common.exceptions import TimeoutException
 from semantic_kernel.functions.kernel_function_decorator import kernel_function
 import os
 from typing import Annotated
 from enum import Enum
-from azure.identity import AzureCliCredential, get_bearer_token_provider
-from openai import AzureOpenAI
+from plugins.shared_ai import get_ai_client, ai_call_limiter, PRIORITY_WEB_ACTION
 from pydantic import BaseModel
-import time
+from PIL import Image
+from collections import OrderedDict
+import imagehash
+import asyncio
+import io
 import logging
 
+try:
+    import pybase64 as base64 # SIMD-accelerated, same API as the stdlib module
+except ImportError:
+    import base64
+
 
 class WebActionType(Enum):
     CLICK = "click"
@@ -20,41 +29,82 @@ class WebActionType(Enum):
     WAIT = "wait"
     NONE = "none"
 
+class TargetNotFoundError(Exception):
+    pass
+
 class WebAction(BaseModel):
     action: WebActionType
     target: str
     content: str
+    target_idx: int | None
     termination_message: str
 
 
+# Screenshots are downscaled by the browser and sent as JPEG to keep the payload and vision token count small
+SCREENSHOT_MAX_SIZE = (1600, 1600)
+SCREENSHOT_JPEG_QUALITY = 60
+SCREENSHOT_DETAIL = "low"
+
+# Wait decisions are reused for screenshots that look the same under a perceptual hash
+ACTION_CACHE_SIZE = 64
+ACTION_CACHE_WAIT_DISTANCE = 4
+
+
+WEB_ACTION_SYSTEM_PROMPT = """Determine the next action to perform on the pictured web page for achieving the objective.
+If there is a cookie banner obstructing the web page (and only if), close this first before continuing with the objective.
+If the objective has been achieved, the action may be none. In that case, provide a termination message that includes any information
+that needs to be retrieved from the web page. If the website appears to be loading, use the wait action. In addition to the action,
+provide the target element and, for click and type actions, the idx of the matching element from the list of elements
+(otherwise null). For type actions, include the content to type."""
+WEB_ACTION_SYSTEM_MESSAGE = {"role": "system", "content": WEB_ACTION_SYSTEM_PROMPT}
+
+# Returns each matching element together with the requested attributes and its visibility
+COLLECT_ELEMENTS_SCRIPT = """
+const [selector, attrs] = arguments;
+return Array.from(document.querySelectorAll(selector)).map(e => ({
+    element: e,
+    attrs: Object.fromEntries(attrs.map(a => [a,
+        a === "tag" ? e.tagName.toLowerCase() :
+        a === "text" ? e.innerText :
+        a === "value" ? (e.type === "password" ? "*".repeat((e.value || "").length) : e.value) : // Current value, not the initial attribute
+        a === "checked" ? (e.type === "checkbox" || e.type === "radio" ? String(e.checked) : null) :
+        e.getAttribute(a)])),
+    visible: !!(e.offsetWidth || e.offsetHeight || e.getClientRects().length)
+}));
+"""
+
 class SeleniumPlugin():
 
-    def __init__(self, ai_endpoint) -> None:
+    def __init__(self, ai_endpoint, headless: bool = True, load_images: bool = True) -> None:
         self.logger = logging.getLogger('plugins.Selenium.selenium_plugin')
 
         # Configure webdriver
         options = webdriver.EdgeOptions()
         options.add_experimental_option('excludeSwitches', ['enable-logging']) # Suppress console logs
+        if headless:
+            options.add_argument('--headless=new')
+            options.add_argument('--disable-gpu')
+            options.add_argument('--window-size=1920,1080') # Headless defaults to a small viewport
+        if not load_images:
+            # Faster page loads, but images will be missing from the screenshots
+            options.add_argument('--blink-settings=imagesEnabled=false')
         self.driver = webdriver.ChromiumEdge(
             options=options
         )
-        token_provider = get_bearer_token_provider(
-            AzureCliCredential(), "https://cognitiveservices.azure.com/.default"
-        )
-        self.ai_client = AzureOpenAI(
-            azure_endpoint=ai_endpoint,
-            azure_ad_token_provider=token_provider,
-            api_version="2024-08-01-preview"
-        )
+        self.ai_client = get_ai_client(ai_endpoint)
+        # The WebDriver session can only run one command at a time, so kernel functions using it must not interleave
+        self.driver_lock = asyncio.Lock()
+        self.action_cache: OrderedDict[tuple[str, imagehash.ImageHash, str], WebAction] = OrderedDict()
 
 
     @kernel_function(
         description="Open a web page to perform an action.",
         name="OpenWebPage"
     )
-    def open_web_page(self, url: Annotated[str, "the url of the web page to open"]) -> str:
+    async def open_web_page(self, url: Annotated[str, "the url of the web page to open"]) -> str:
         self.logger.info(f"Navigating to {url}")
-        self.driver.get(url)
+        async with self.driver_lock:
+            await asyncio.to_thread(self.driver.get, url)
         return "Web page opened. You may now perform actions."
 
 
@@ -62,86 +112,180 @@ class SeleniumPlugin():
         description="Perform an action on the current web page.",
         name="PerformWebAction"
     )
-    def perform_web_action(self, action_description: Annotated[str, "The action to achieve on the web page."]) -> str:
-        done = False
+    async def perform_web_action(self, action_description: Annotated[str, "The action to achieve on the web page."]) -> str:
+        async with self.driver_lock:
+            return await self.run_web_action(action_description)
+
+
+    async def run_web_action(self, action_description: str) -> str:
         max_attempts = 15
+        max_unchanged_steps = 2
         current_attempt = 0
-        while not done:
+        unchanged_steps = 0 # Consecutive non-wait actions after which the page looked the same
+        wait_streak = 0
+        last_action = None
+        last_state = None
+        last_result = None
+        last_cached = False
+        while True:
             current_attempt += 1
             if current_attempt > max_attempts:
                 return "Max attempts reached. Could not complete the action."
-            time.sleep(0.2)
-            action = self.get_web_action(action_description)
+            # Cached wait decisions are only reused while waiting, and never twice in a row so the model gets to see the page again
+            use_cache = last_action is None or (last_action.action == WebActionType.WAIT and not last_cached)
+            action, elements, page_state, last_cached = await self.get_web_action(action_description, last_result, use_cache)
             self.logger.info(f"Performing action: {action}")
-            message = self.execute_web_action(action)
             if action.action == WebActionType.NONE:
-                done = True
-                message = action.termination_message
-        return message
+                return action.termination_message
+
+            # Give up early if the previous actions had no effect on the page (neither visible nor in the DOM)
+            if last_action is not None and last_action.action != WebActionType.WAIT and page_state == last_state:
+                unchanged_steps += 1
+                if unchanged_steps >= max_unchanged_steps:
+                    return f"The page did not change after performing '{last_action.action.value}' on '{last_action.target}'. Could not complete the action."
+            else:
+                unchanged_steps = 0
+
+            # Back off exponentially while the page keeps loading
+            wait_time = min(0.5 * 2 ** wait_streak, 8)
+            wait_streak = wait_streak + 1 if action.action == WebActionType.WAIT else 0
+
+            try:
+                last_result = await self.execute_web_action(action, elements, wait_time)
+                last_state = page_state
+            except TargetNotFoundError as e:
+                # Nothing was performed, so the next page must not be judged as unchanged by this action
+                last_result = str(e)
+                last_state = None
+            last_action = action
     
 
-    def get_web_action(self, objective: Annotated[str, "the objective to achieve on the web page"]) -> WebAction:
+    async def get_web_action(self, objective: Annotated[str, "the objective to achieve on the web page"], previous_result: str | None = None, use_cache: bool = True) -> tuple[WebAction, list[WebElement], tuple[imagehash.ImageHash, str], bool]:
+        # Wait for the page to settle after the previous action
+        await asyncio.to_thread(self._wait_for_page_ready)
+
         # Get screenshot of the web page
-        screenshot_b64 = self.capture_current_page()
-        image_url = f"data:image/png;base64,{screenshot_b64}"
+        screenshot = await asyncio.to_thread(self.capture_current_page)
+
+        # List the interactive elements so the target can be selected in the same call. The driver only handles one
+        # command at a time, so just the hashing of the screenshot runs alongside.
+        page_hash, (elements, records) = await asyncio.gather(
+            asyncio.to_thread(self._hash_screenshot, screenshot),
+            asyncio.to_thread(self._collect_elements, "button, a, input", ["tag", "text", "name", "placeholder", "value", "checked"])
+        )
+        page_state = (page_hash, str(records))
+
+        # Skip the AI call if the page still looks like one that was judged to be loading
+        cached_action = self._get_cached_action(objective, page_state) if use_cache else None
+        if cached_action is not None:
+            self.logger.info("Reusing cached wait action for unchanged page")
+            return cached_action, elements, page_state, True
+
+        image_url = "data:image/jpeg;base64," + screenshot
 
         # Use AI to determine the next action
-        response = self.ai_client.beta.chat.completions.parse(
-            model="gpt-4o",
-            messages=[
-                { "role": "system",
-                    "content":
-                            """Determine the next action to perform on the pictured web page for achieving the objective.
-                            If there is a cookie banner obstructing the web page (and only if), close this first before continuing with the objective.
-                            If the objective has been achieved, the action may be none. In that case, provide a termination message that includes any information
-                            that needs to be retrieved from the web page. If the website appears to be loading, use the wait action. In addition to the action,
-                            provide the target element. For type actions, include the content to type."""
-                            },
-                { "role": "user", "content": [  
-                    { 
-                        "type": "text", 
-                        "text": f"Objective: {objective}" 
-                    },
-                    { 
-                        "type": "image_url",
-                        "image_url": {
-                            "url": image_url
+        async with ai_call_limiter.slot(PRIORITY_WEB_ACTION):
+            response = await self.ai_client.beta.chat.completions.parse(
+                model="gpt-4o",
+                messages=[
+                    WEB_ACTION_SYSTEM_MESSAGE,
+                    { "role": "user", "content": [  
+                        { 
+                            "type": "text", 
+                            "text": f"Objective: {objective}\n\nResult of the previous action: {previous_result}\n\nElements: {records}" 
+                        },
+                        { 
+                            "type": "image_url",
+                            "image_url": {
+                                "url": image_url,
+                                "detail": SCREENSHOT_DETAIL
+                            }
                         }
-                    }
-                ] } 
-            ],
-            response_format=WebAction
-        )
+                    ] } 
+                ],
+                response_format=WebAction
+            )
         result = response.choices[0].message.parsed
-        return result
+        self._cache_action(objective, page_state, result)
+        return result, elements, page_state, False
     
 
+    def _wait_for_page_ready(self, timeout: float = 5) -> None:
+        try:
+            WebDriverWait(self.driver, timeout).until(
+                lambda driver: driver.execute_script("return document.readyState") == "complete"
+            )
+        except TimeoutException:
+            # Carry on with whatever has rendered, the AI can still decide to wait
+            self.logger.info(f"Page did not finish loading within {timeout} seconds")
+
+
     def capture_current_page(self) -> str:
-        body_element = self.driver.find_element(By.TAG_NAME, "body")
-        screenshot_b64 = body_element.screenshot_as_base64
-        return screenshot_b64
+        # Let the browser scale and encode the JPEG directly, the base64 data it returns is sent to the AI as is
+        metrics = self.driver.execute_cdp_cmd("Page.getLayoutMetrics", {})
+        viewport = metrics["cssVisualViewport"]
+        device_pixel_ratio = metrics["visualViewport"]["clientWidth"] / viewport["clientWidth"] # The legacy metrics are in device pixels
+        scale = min(1, SCREENSHOT_MAX_SIZE[0] / viewport["clientWidth"], SCREENSHOT_MAX_SIZE[1] / viewport["clientHeight"]) / device_pixel_ratio
+        screenshot = self.driver.execute_cdp_cmd("Page.captureScreenshot", {
+            "format": "jpeg",
+            "quality": SCREENSHOT_JPEG_QUALITY,
+            "clip": {
+                "x": viewport["pageX"],
+                "y": viewport["pageY"],
+                "width": viewport["clientWidth"],
+                "height": viewport["clientHeight"],
+                "scale": scale
+            }
+        })
+        return screenshot["data"]
+
+
+    def _hash_screenshot(self, screenshot: str) -> imagehash.ImageHash:
+        return imagehash.phash(Image.open(io.BytesIO(base64.b64decode(screenshot))))
+
+
+    def _get_cached_action(self, objective: str, page_state: tuple[imagehash.ImageHash, str]) -> WebAction | None:
+        page_hash, records = page_state
+        for key, action in self.action_cache.items():
+            cached_objective, cached_hash, cached_records = key
+            # The element list is half of the prompt, so it has to match exactly
+            if cached_objective != objective or cached_records != records:
+                continue
+            # Loading pages rarely render identically twice, so near-identical screenshots match as well
+            if cached_hash - page_hash <= ACTION_CACHE_WAIT_DISTANCE:
+                self.action_cache.move_to_end(key)
+                return action
+        return None
 
 
-    def execute_web_action(self, action: WebAction) -> str:
+    def _cache_action(self, objective: str, page_state: tuple[imagehash.ImageHash, str], action: WebAction) -> None:
+        # Only waiting is safe to replay, other actions change the page in ways the hash does not pick up (e.g. typed text)
+        if action.action != WebActionType.WAIT:
+            return
+        key = (objective, *page_state)
+        self.action_cache[key] = action
+        self.action_cache.move_to_end(key)
+        if len(self.action_cache) > ACTION_CACHE_SIZE:
+            self.action_cache.popitem(last=False)
+
+
+    async def execute_web_action(self, action: WebAction, elements: list[WebElement], wait_time: float = 3) -> str:
+        if action.action in (WebActionType.CLICK, WebActionType.TYPE_TEXT, WebActionType.TYPE_ENTER):
+            if action.target_idx is None or not 0 <= action.target_idx < len(elements):
+                raise TargetNotFoundError(f"Could not find the target element: {action.target} (idx {action.target_idx})")
+            element = elements[action.target_idx]
+
         if action.action == WebActionType.CLICK:
-            buttons = self.driver.find_elements(By.TAG_NAME, "button")
-            anchors = self.driver.find_elements(By.TAG_NAME, "a")
-            elements = buttons + anchors
-            element = self.match_clickable(elements, action.target)
-            element.click()
+            await asyncio.to_thread(element.click)
             return f"Clicked the element: {element}"
         elif action.action == WebActionType.TYPE_TEXT:
-            elements = self.driver.find_elements(By.TAG_NAME, "input")
-            element = self.match_input(elements, action.target)
-            element.send_keys(action.content)
+            await asyncio.to_thread(element.send_keys, action.content)
             return f"Typed '{action.content}' in the input field: {element}"
         elif action.action == WebActionType.TYPE_ENTER:
-            elements = self.driver.find_elements(By.TAG_NAME, "input")
-            element = self.match_input(elements, action.target)
-            element.send_keys(Keys.RETURN)
+            await asyncio.to_thread(element.send_keys, Keys.RETURN)
             return f"Pressed Enter in the input field: {element}"
         elif action.action == WebActionType.WAIT:
-            time.sleep(3)
+            await asyncio.sleep(wait_time)
             return "Waiting..."
         elif action.action == WebActionType.NONE:
             return action.termination_message
@@ -149,27 +293,9 @@ class SeleniumPlugin():
             raise ValueError(f"Unsupported action type: {action.action}")
         
 
-    def match_clickable(self, elements: list[WebElement], target: Annotated[str, "the element to find"]) -> WebElement:
-        elements_dicts = [{"idx": i, "text": element.text} for i, element in enumerate(elements) if element.is_displayed()]
-        idx = self.match_element_idx(elements_dicts, target)
-        return elements[idx]
-    
-
-    def match_input(self, elements: list[WebElement], target: Annotated[str, "the element to find"]) -> WebElement:
-        elements_dicts = [{"idx": i, "name": element.get_attribute("name"), "placeholder": element.get_attribute("placeholder")} for i, element in enumerate(elements) if element.is_displayed()]
-        idx = self.match_element_idx(elements_dicts, target)
-        return elements[idx]
-    
-
-    def match_element_idx(self, elements: list[dict], target: Annotated[str, "the element to find"]) -> WebElement:
-        class ResponseFormat(BaseModel): selected_element_idx: int
-        response = self.ai_client.beta.chat.completions.parse(
-            model="gpt-4o",
-            messages=[
-                {"role": "system", "content": f"Select the most relevant element from the list that best matches the following description: {target}"},
-                {"role": "user", "content": f"Elements: {elements}"}
-            ],
-            response_format=ResponseFormat
-        )
-        idx = response.choices[0].message.parsed.selected_element_idx
-        return idx
\ No newline at end of file
+    def _collect_elements(self, selector: str, attrs: list[str]) -> tuple[list[WebElement], list[dict]]:
+        # Read the attributes of all matching elements in a single script call instead of one WebDriver round-trip per element
+        results = self.driver.execute_script(COLLECT_ELEMENTS_SCRIPT, selector, attrs)
+        elements = [result["element"] for result in results]
+        records = [{"idx": i, **{k: v for k, v in result["attrs"].items() if v}} for i, result in enumerate(results) if result["visible"]]
+        return elements, records
@@ -1,24 +1,38 @@
 from typing import Annotated
 from semantic_kernel.functions.kernel_function_decorator import kernel_function
 from pydantic import BaseModel, create_model
-from azure.identity import AzureCliCredential, get_bearer_token_provider
+from selectolax.lexbor import LexborHTMLParser
+from urllib.parse import urljoin
+import asyncio
 import logging
-import requests
-from openai import AzureOpenAI
+import httpx
+import orjson
+from plugins.shared_ai import get_ai_client, ai_call_limiter, PRIORITY_EXTRACTION
+
+# Page content is parsed in chunks of this size, in parallel waves of up to CHUNKS_PER_WAVE chunks
+CHUNK_SIZE = 30_000
+CHUNKS_PER_WAVE = 10
+
+EXTRACTION_SYSTEM_PROMPT = "You will be given (part of) the text content and links of a website. Find the information specified below. If you cannot find the information, find the absolute URL to a location where that information may be found."
+EXTRACTION_SYSTEM_MESSAGE = {"role": "system", "content": EXTRACTION_SYSTEM_PROMPT}
+
 
 class WebPlugin:
 
     def __init__(self, ai_endpoint: str, search_key: str):
-        token_provider = get_bearer_token_provider(
-            AzureCliCredential(), "https://cognitiveservices.azure.com/.default"
-        )
-        self.ai_client = AzureOpenAI(
-            azure_endpoint=ai_endpoint,
-            azure_ad_token_provider=token_provider,
-            api_version="2024-08-01-preview"
-        )
+        self.ai_client = get_ai_client(ai_endpoint)
         self.search_key = search_key
 
+        # Reuse connections across calls instead of a new handshake per request. Pages are fetched with a separate
+        # client so the Bing subscription key is never sent to other sites.
+        self.page_client = httpx.AsyncClient(http2=True, follow_redirects=True)
+        self.search_client = httpx.AsyncClient(http2=True, headers={"Ocp-Apim-Subscription-Key": self.search_key})
+
+
+    async def close(self) -> None:
+        await self.page_client.aclose()
+        await self.search_client.aclose()
+
 
     @kernel_function(
         description="Extract particular information from a web site based based on its source code. Use this function if the information is not available in the search results.",
@@ -48,53 +62,123 @@ class WebPlugin:
             logging.info(f"Step {step}: Fetching {url}...")
 
             # Get the source code from a url
-            response = requests.get(url)
-            source_code = response.text
+            response = await self.page_client.get(url)
+            page_content = self.extract_page_content(response.text, str(response.url)) # Resolve links against the final URL after redirects
+
+            # Parse the chunks in parallel waves and stop as soon as one of them contains the data
+            chunks = self.split_page_content(page_content)
+            next_urls = {}
+            errors = []
+            for wave_start in range(0, len(chunks), CHUNKS_PER_WAVE):
+                if len(extracted_data) > 0:
+                    break
+                if wave_start > 0:
+                    logging.info(f"Data not found in the first {wave_start} of {len(chunks)} chunks of {url}, parsing the next wave...")
+                wave = chunks[wave_start:wave_start + CHUNKS_PER_WAVE]
+                tasks = {asyncio.create_task(self.parse_chunk(chunk, fields_to_extract, ParseResult)): wave_start + i for i, chunk in enumerate(wave)}
+                pending = set(tasks)
+                try:
+                    while pending and len(extracted_data) == 0:
+                        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                        for task in done:
+                            # A single failing chunk (e.g. content filter) should not fail the whole extraction
+                            if task.exception() is not None:
+                                logging.warning(f"Parsing chunk {tasks[task]} of {url} failed: {task.exception()}")
+                                errors.append(task.exception())
+                                continue
+                            result = task.result()
+                            if len(result.extracted_data) > 0:
+                                extracted_data = result.extracted_data
+                                break
+                            if result.next_url != url:
+                                next_urls[tasks[task]] = result.next_url
+                finally:
+                    for task in pending:
+                        task.cancel()
 
-            # Cap the source code at 300k characters
-            if len(source_code) > 300_000:
-                source_code = source_code[:300_000]
+            if len(extracted_data) == 0:
+                if chunks and len(errors) == len(chunks):
+                    raise errors[0]
+                if next_urls:
+                    # Follow the suggestion from the earliest chunk of the page
+                    url = next_urls[min(next_urls)]
+                else:
+                    return "The requested data was not found."
 
-            # Parse the source code
-            completion = self.ai_client.beta.chat.completions.parse(
+        return extracted_data
+    
+
+    async def parse_chunk(self, chunk: str, fields_to_extract: list[str], response_format: type[BaseModel]) -> BaseModel:
+        async with ai_call_limiter.slot(PRIORITY_EXTRACTION):
+            completion = await self.ai_client.beta.chat.completions.parse(
                 model="gpt-4o",
                 messages=[
-                    {"role": "system", "content": "You will be given the source code of a website. Find the information specified below. If you cannot find the information, find the absolute URL to a location where that information may be found."},
-                    {"role": "user", "content": f"The information to extract: {fields_to_extract}\n\nSource code:\n{source_code}"},
+                    EXTRACTION_SYSTEM_MESSAGE,
+                    {"role": "user", "content": f"The information to extract: {fields_to_extract}\n\nWebsite content:\n{chunk}"},
                 ],
-                response_format=ParseResult,
+                response_format=response_format,
             )
-            result = completion.choices[0].message.parsed
-            if len(result.extracted_data) > 0:
-                extracted_data = result.extracted_data
-            else:
-                if result.next_url != url:
-                    url = result.next_url   
-                else:
-                    return "The requested data was not found."      
+        return completion.choices[0].message.parsed
+
+
+    def extract_page_content(self, source_code: str, url: str) -> str:
+        # Reduce the page to its visible text and links, markup is irrelevant for extraction and costs tokens
+        tree = LexborHTMLParser(source_code)
+        tree.strip_tags(["script", "style", "noscript", "svg", "template"])
+        root = tree.body or tree.root
+        if root is None:
+            return ""
+        lines = [line.strip() for line in root.text(separator="\n").splitlines()]
+        text = "\n".join(line for line in lines if line)
+        links = [f"{a.text(strip=True)} ({urljoin(url, a.attributes.get('href') or '')})" for a in root.css("a[href]")]
+        return f"{text}\n\nLinks:\n" + "\n".join(links)
+
+
+    def split_page_content(self, page_content: str) -> list[str]:
+        chunks = []
+        start = 0
+        while start < len(page_content):
+            end = start + CHUNK_SIZE
+            if end < len(page_content):
+                # Split at a line break so lines stay intact
+                boundary = page_content.rfind("\n", start, end)
+                if boundary > start:
+                    end = boundary + 1
+            chunks.append(page_content[start:end])
+            start = end
+        return chunks
 
-        return extracted_data
-    
 
     @kernel_function(
-        description="Perform a web search with a query to find relevant URLs, snippets, and deep links.",
+        description="Perform a web search with one or more queries to find relevant URLs, snippets, and deep links. Pass several differently phrased queries for better recall.",
         name="WebSearch"
     )
-    def perform_web_search(self, query: Annotated[str, "Search query"]) -> Annotated[list[str], "Top 5 search results"]:
+    async def perform_web_search(self, queries: Annotated[list[str], "Search queries"]) -> Annotated[list[str], "Top 5 search results"]:
         search_url = "https://api.bing.microsoft.com/v7.0/search"
-        headers = {"Ocp-Apim-Subscription-Key": self.search_key}
-        params = {"q": query}
-        response = requests.get(search_url, headers=headers, params=params)
-        response.raise_for_status()
-        search_results = response.json()
+        responses = await asyncio.gather(*[self.search_client.get(search_url, params={"q": query}) for query in queries])
+
+        # Rank results by their position across all queries
+        ranked_results = []
+        for query_idx, response in enumerate(responses):
+            response.raise_for_status()
+            search_results = orjson.loads(response.content)
+            for rank, result in enumerate(search_results.get("webPages", {}).get("value", [])):
+                ranked_results.append((rank, query_idx, result))
+        ranked_results.sort(key=lambda ranked_result: ranked_result[:2])
 
-        # Return top 5 search results
+        # Return top 5 search results, skipping URLs returned by more than one query
         results = []
-        for result in search_results["webPages"]["value"][:5]:
+        seen_urls = set()
+        for _, _, result in ranked_results:
+            if result["url"] in seen_urls:
+                continue
+            seen_urls.add(result["url"])
             name = result["name"]
             url = result["url"]
             snippet = result["snippet"]
             deep_links = result.get("deepLinks", [])
             results.append({"name": name, "url": url, "snippet": snippet, "deep_links": deep_links})
+            if len(results) == 5:
+                break
 
         return results
\ No newline at end of file
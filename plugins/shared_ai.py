@@ -0,0 +1,84 @@
+from azure.identity.aio import DefaultAzureCredential, get_bearer_token_provider
+from openai import AsyncAzureOpenAI
+from contextlib import asynccontextmanager
+import asyncio
+import heapq
+import itertools
+
+# Priorities for AI calls made by the plugins, higher runs first. The user-facing chat completion
+# in app.py is not routed through the limiter at all, so it never queues behind plugin calls.
+PRIORITY_WEB_ACTION = 5
+PRIORITY_EXTRACTION = 1
+
+MAX_CONCURRENT_AI_CALLS = 4
+
+ai_clients: dict[str, tuple[AsyncAzureOpenAI, DefaultAzureCredential]] = {}
+
+
+def get_ai_client(ai_endpoint: str) -> AsyncAzureOpenAI:
+    # One credential and client per endpoint, shared by all plugins. The credential caches tokens in memory,
+    # so the Azure CLI is only invoked when the token actually expires. The async credential keeps token
+    # fetches (managed identity probe, az subprocess) from blocking the event loop.
+    if ai_endpoint not in ai_clients:
+        credential = DefaultAzureCredential(exclude_interactive_browser_credential=True)
+        token_provider = get_bearer_token_provider(credential, "https://cognitiveservices.azure.com/.default")
+        client = AsyncAzureOpenAI(
+            azure_endpoint=ai_endpoint,
+            azure_ad_token_provider=token_provider,
+            api_version="2024-08-01-preview"
+        )
+        ai_clients[ai_endpoint] = (client, credential)
+    return ai_clients[ai_endpoint][0]
+
+
+async def close_ai_clients() -> None:
+    while ai_clients:
+        _, (client, credential) = ai_clients.popitem()
+        await client.close()
+        await credential.close()
+
+
+class PrioritySemaphore():
+    """Semaphore that hands free slots to the highest priority waiter first (FIFO within a priority)."""
+
+    def __init__(self, limit: int) -> None:
+        self.limit = limit
+        self.active = 0
+        self.waiters = []
+        self.counter = itertools.count()
+
+
+    @asynccontextmanager
+    async def slot(self, priority: int):
+        await self.acquire(priority)
+        try:
+            yield
+        finally:
+            self.release()
+
+
+    async def acquire(self, priority: int) -> None:
+        if self.active < self.limit and not self.waiters:
+            self.active += 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiters, (-priority, next(self.counter), future))
+        try:
+            await future
+        except asyncio.CancelledError:
+            # The slot may have been handed over just before the cancellation
+            if future.done() and not future.cancelled():
+                self.release()
+            raise
+
+
+    def release(self) -> None:
+        self.active -= 1
+        while self.waiters and self.active < self.limit:
+            _, _, future = heapq.heappop(self.waiters)
+            if not future.done():
+                self.active += 1
+                future.set_result(None)
+
+
+ai_call_limiter = PrioritySemaphore(MAX_CONCURRENT_AI_CALLS)